@@ -9,6 +9,8 @@ from glob import glob
 from urllib.parse import urlparse
 import shutil
 import struct
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 __version__ = '0.5'
 
@@ -83,12 +85,18 @@ __version__ = '0.5'
 # 12) **--make_shadow_edge_visible**: Clears body pixels that overlap with the
 #     edge of the shadow in up/right/down stand/swordprimed poses, which helps
 #     the generated sprite not interfere with glitches and bomb jumps.
+#
+# 13) **--seed**: Seed for the random number generator.  Running again with
+#     the same seed, source spritesheet, options, and ./sprites/ folder
+#     produces the same shuffled sprite.
+#
+# 14) **--count**: Generate this many shuffled sprites in one run, numbered
+#     like `Spriteshuffled_head_rom_1.zspr`, `Spriteshuffled_head_rom_2.zspr`,
+#     etc.  The source spritesheet and ./sprites/ folder are only loaded once,
+#     so this is much faster than running the shuffler repeatedly.
 
 # General rom patching logic copied from https://github.com/LLCoolDave/ALttPEntranceRandomizer
 
-def write_byte(array, address, value):
-    array[address] = value
-
 # Tile offsets starting at 0x80000 for all head and body sprites
 # These should really be 2D.  Sorry.
 #
@@ -116,6 +124,13 @@ head_offsets = { # Row from spritesheet commented at the end
 
 walk_head_offsets = [0, 16*10+3, 16*10+4]
 
+# head_offsets frozen into a tuple of poses and a parallel tuple of facings,
+# plus each pose's index, so the walk cycle fixup can work on indices
+head_offsets_list = tuple(head_offsets)
+head_facings = tuple(head_offsets.values())
+head_offset_index = {off: i for i, off in enumerate(head_offsets_list)}
+nonwalk_head_indices = tuple(i for i, off in enumerate(head_offsets_list) if off not in walk_head_offsets)
+
 body_offsets = [
 16*1+0, 16*1+1, 16*1+2, 16*1+3, 16*1+4, 16*1+5, 16*1+6,                 # B0-6
 16*2+0, 16*2+1, 16*2+2, 16*2+3, 16*2+4, 16*2+5, 16*2+6, 16*2+7,         # C0-7
@@ -144,132 +159,258 @@ bunny_offsets = [
 16*25+5, 16*25+7,                                              # Z5, Z7
 16*26+0, 16*26+1, 16*26+2, 16*26+3, 16*26+4, 16*26+5, 16*26+6] # AA0-6
 
-def pick_random_zspr(scan_offset, spritelist):
-    basespriteoffset = 0
-    basepaletteoffset = 0
-    srcsheet = []
+# Pool of every head and body offset, shuffled together for --chaos
+all_offsets = head_offsets_list + tuple(body_offsets)
+
+# Byte offsets within the spritesheet of the top-left tile of each of the
+# offsets above, in the same order, so shuffling doesn't redo the * 0x40
+# for every tile
+head_byte_offsets = tuple(off*0x40 for off in head_offsets)
+body_byte_offsets = tuple(off*0x40 for off in body_offsets)
+all_byte_offsets = head_byte_offsets + body_byte_offsets
+bunny_byte_offsets = tuple(off*0x40 for off in bunny_offsets)
+
+# .zspr header: magic, version, checksum, checksum complement, sprite sheet
+# pointer/length, palettes pointer/length, sprite type, reserved
+zspr_header = struct.Struct('<4sBHHLHLHH6s')
+# Sprite sheet pointer/length and palettes pointer/length, starting at byte 9
+zspr_pointers = struct.Struct('<LHLH')
+zspr_checksum = struct.Struct('<HH')
+
+# Where Link's spritesheet, palettes and glove colors live in the ROM
+rom_sprite_offset = 0x80000
+rom_palette_offset = 0xdd308
+rom_glove_offset = 0xdedf5
+
+# Sprite list saved from the last scan of ./sprites/, along with the mtime of
+# every directory in it; the list is reused as long as none of them changed
+sprite_list_cache = os.path.join('sprites', '.zspr_index.json')
+
+def read_sprite_list_cache():
+    try:
+        with open(sprite_list_cache) as cache_file:
+            cache = json.load(cache_file)
+        for dirpath, mtime in cache['dirs'].items():
+            if os.stat(dirpath).st_mtime_ns != mtime:
+                return None
+        return tuple(Path(path) for path in cache['sprites'])
+    except (OSError, ValueError, KeyError, AttributeError, TypeError):
+        return None
+
+# Sorted so that the same random seed picks the same sprites on any filesystem.
+# Cached for the lifetime of the process; dump_sprites clears it after
+# changing the contents of ./sprites/
+@functools.lru_cache(maxsize=1)
+def find_sprites():
+    spritelist = read_sprite_list_cache()
+    if spritelist is not None:
+        return spritelist
 
-    if not spritelist:
-        logger.info("ERROR: couldn't find sprite for shuffling, make sure you've run --dumpsprites first.")
-        return
+    try:
+        # Create the cache file before recording mtimes, since adding it
+        # changes the mtime of ./sprites/, and record them before scanning so
+        # that anything added mid-scan invalidates the cache next time
+        open(sprite_list_cache, 'a').close()
+        dir_mtimes = {dirpath: os.stat(dirpath).st_mtime_ns for dirpath, _, _ in os.walk('sprites')}
+    except OSError:
+        dir_mtimes = None
 
-    # Pick a random sprite, but make sure it has sprite data at the chosen
-    # offset first (don't want the shuffled spritesheet to pick from the head
-    # region of body-only sprites or vice versa, since that's boring.)
-    foundspr = False
-    while foundspr is False:
-        srcpath = random.choice(spritelist)
-        srcsheet = srcpath.read_bytes()
-        basespriteoffset = struct.unpack_from('<i', srcsheet, 9)[0]
-        basepaletteoffset = struct.unpack_from('<i', srcsheet, 15)[0]
+    spritelist = tuple(sorted(Path('./sprites/').rglob('*.zspr')))
+
+    if dir_mtimes is not None:
+        try:
+            with open(sprite_list_cache, 'w') as cache_file:
+                json.dump({'dirs': dir_mtimes, 'sprites': [str(path) for path in spritelist]}, cache_file)
+        except OSError:
+            pass
+
+    return spritelist
+
+# Keep every spritesheet that has been loaded around instead of re-reading and
+# re-parsing it each time; the full alttpr sprite corpus is only a few dozen
+# MB, and a bounded cache smaller than it would thrash on every rebuild
+@functools.lru_cache(maxsize=None)
+def load_zspr(srcpath):
+    try:
+        srcsheet = memoryview(srcpath.read_bytes())
+    except OSError:
+        # Listed but unreadable (e.g. deleted since the sprite list was
+        # saved), gets skipped as corrupted
+        return memoryview(b''), 0, 0
+    if len(srcsheet) < 9 + zspr_pointers.size:
+        # Too short to hold the header, gets skipped as corrupted
+        return srcsheet, 0, 0
+    basespriteoffset, _, basepaletteoffset, _ = zspr_pointers.unpack_from(srcsheet, 9)
+    return srcsheet, basespriteoffset, basepaletteoffset
+
+blank_tile_row = bytes(0x40)
+
+# Whether either row of the 2x2 tile at srcoff has any nonzero pixel data.
+# Comparing each row against a blank row is a single memcmp, which beats
+# any() walking all 0x40 bytes whenever the row is blank.
+def has_sprite_data(srcsheet, srcoff):
+    return (srcsheet[srcoff:srcoff+0x40].tobytes() != blank_tile_row or
+            srcsheet[srcoff+0x200:srcoff+0x240].tobytes() != blank_tile_row)
+
+# Load every .zspr in spritelist once, dropping corrupted ones, and index them
+# by each of the given offsets they have sprite data at, so that pick_random_zspr
+# never has to re-read, re-validate, or re-scan a file while shuffling.  Only
+# the offsets the enabled passes will look up are scanned.
+def build_sprite_index(spritelist, offsets):
+    logger = logging.getLogger('')
+    sprite_index = {off: [] for off in offsets}
+
+    # Reading the files is I/O bound and releases the GIL, so overlap the reads
+    # across a few threads
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        loaded = list(executor.map(load_zspr, spritelist))
+
+    for srcpath, (srcsheet, basespriteoffset, basepaletteoffset) in zip(spritelist, loaded):
         if (basespriteoffset == 0 or
             basepaletteoffset == 0 or
             basespriteoffset + 0x7000 > basepaletteoffset or
             basespriteoffset + 0x7000 > len(srcsheet) or
             basepaletteoffset + 124 > len(srcsheet)):
             logger.info("WARNING: skipping corrupted sprite " + str(srcpath))
-        else:
-            for tst_h in range(2):
-                srcoff = basespriteoffset + scan_offset*0x40 + tst_h*0x200
-                for tst_w in range(0x40):
-                    if srcsheet[srcoff + tst_w]:
-                        foundspr = True
-                        break
+            continue
 
-    return srcsheet, basespriteoffset, basepaletteoffset
+        for off in offsets:
+            if has_sprite_data(srcsheet, basespriteoffset + off*0x40):
+                sprite_index[off].append((srcsheet, basespriteoffset, basepaletteoffset))
 
-def shuffle_offsets(args, sprite, base_offsets, shuffled_offsets, spritelist, current_sprite):
-    for off in range(len(base_offsets)):
-        if (args.multisprite_simple or args.multisprite_full):
-            if (args.multisprite_simple):
-                srcsheet, baseoff, paloff = pick_random_zspr(base_offsets[off], spritelist)
-            else:
-                srcsheet, baseoff, paloff = pick_random_zspr(shuffled_offsets[off], spritelist)
-        else:
-            srcsheet = current_sprite
-            baseoff = 0
+    return sprite_index
 
-        for h in range(2): # All shuffled sprites are 2x2 tiles
-            if (args.multisprite_simple):
-                srcoff = baseoff + base_offsets[off]*0x40 + h*0x200
-            else:
-                srcoff = baseoff + shuffled_offsets[off]*0x40 + h*0x200
+# Returns None if no sprite has data at scan_offset; callers report that
+# once per pass rather than once per tile
+def pick_random_zspr(scan_offset, sprite_index, rng):
+    # Pick a random sprite, but make sure it has sprite data at the chosen
+    # offset first (don't want the shuffled spritesheet to pick from the head
+    # region of body-only sprites or vice versa, since that's boring.)
+    candidates = sprite_index.get(scan_offset)
 
-            dstoff = base_offsets[off]*0x40 + h*0x200
+    if not candidates:
+        return
 
-            for w in range(0x40):
-                write_byte(sprite, dstoff+w, srcsheet[srcoff+w])
+    return rng.choice(candidates)
+
+def copy_tiles(sprite, srcsheet, tile_pairs):
+    # All shuffled sprites are 2x2 tiles; the bottom row is 0x200 bytes after
+    # the top row, so copy both rows of each (srcoff, dstoff) pair directly
+    for srcoff, dstoff in tile_pairs:
+        sprite[dstoff:dstoff+0x40] = srcsheet[srcoff:srcoff+0x40]
+        sprite[dstoff+0x200:dstoff+0x240] = srcsheet[srcoff+0x200:srcoff+0x240]
+
+def shuffle_offsets(args, sprite, base_offsets, base_byte_offsets, shuffled_indices, sprite_index, current_sprite, rng):
+    # shuffled_indices[i] is the index into base_offsets of the tile that ends
+    # up at base_offsets[i], so both the source tile and its byte offset come
+    # straight from the precomputed tables
+    if not (args.multisprite_simple or args.multisprite_full):
+        # Every tile comes from the unshuffled spritesheet, so the whole pass
+        # is a fixed permutation that can be laid out up front.  Each pass
+        # only writes its own tiles, so a tile shuffled onto itself is still
+        # unchanged in sprite and can be skipped.
+        tile_pairs = [(base_byte_offsets[src], dstoff) for src, dstoff in zip(shuffled_indices, base_byte_offsets)
+                      if base_byte_offsets[src] != dstoff]
+        copy_tiles(sprite, current_sprite, tile_pairs)
+        return
+
+    # --multisprite_simple keeps every tile in place and only picks which
+    # sprite it comes from; --multisprite_full also moves it
+    if (args.multisprite_simple):
+        src_indices = range(len(base_offsets))
+    else:
+        src_indices = shuffled_indices
+
+    missing = 0
+    for src, dstoff in zip(src_indices, base_byte_offsets):
+        # Leave the tile as-is if no sprite has data at this offset
+        picked = pick_random_zspr(base_offsets[src], sprite_index, rng)
+        if picked is None:
+            missing += 1
+            continue
+
+        srcsheet, baseoff, paloff = picked
+        srcoff = baseoff + base_byte_offsets[src]
+
+        copy_tiles(sprite, srcsheet, ((srcoff, dstoff),))
+
+    if missing:
+        logger = logging.getLogger('')
+        logger.info("WARNING: no sprite in ./sprites/ has data at %d of the shuffled sprite positions, leaving those unchanged" % missing)
+
+def write_file(outfilename, *chunks):
+    with open(outfilename, 'wb', buffering=0) as outfile:
+        for data in chunks:
+            view = memoryview(data)
+            while view:
+                view = view[outfile.write(view):]
 
 # .zspr file dumping logic copied with permission from SpriteSomething:
 # https://github.com/Artheau/SpriteSomething/blob/master/source/meta/classes/spritelib.py#L443 (thanks miketrethewey!)
 def dump_zspr(basesprite, basepalette, baseglove, outfilename):
-    palettes = basepalette
-    # Add glove data
-    palettes.extend(baseglove)
     HEADER_STRING = b"ZSPR"
     VERSION = 0x01
     SPRITE_TYPE = 0x01  # this format has "1" for the player sprite
     RESERVED_BYTES = b'\x00\x00\x00\x00\x00\x00'
-    QUAD_BYTE_NULL_CHAR = b'\x00\x00\x00\x00'
     DOUBLE_BYTE_NULL_CHAR = b'\x00\x00'
     SINGLE_BYTE_NULL_CHAR = b'\x00'
 
-    write_buffer = bytearray()
-
-    write_buffer.extend(HEADER_STRING)
-    write_buffer.extend(struct.pack('B', VERSION)) # as_u8
-    checksum_start = len(write_buffer)
-    write_buffer.extend(QUAD_BYTE_NULL_CHAR) # checksum
-    sprite_sheet_pointer = len(write_buffer)
-    write_buffer.extend(QUAD_BYTE_NULL_CHAR)
-    write_buffer.extend(struct.pack('<H', len(basesprite))) # as_u16
-    palettes_pointer = len(write_buffer)
-    write_buffer.extend(QUAD_BYTE_NULL_CHAR)
-    write_buffer.extend(struct.pack('<H', len(palettes))) # as_u16
-    write_buffer.extend(struct.pack('<H', SPRITE_TYPE)) # as_u16
-    write_buffer.extend(RESERVED_BYTES)
-    # sprite.name
-    write_buffer.extend(outfilename.encode('utf-16-le'))
-    write_buffer.extend(DOUBLE_BYTE_NULL_CHAR)
-    # author.name
-    write_buffer.extend("ALttPLinkSpriteShuffler".encode('utf-16-le'))
-    write_buffer.extend(DOUBLE_BYTE_NULL_CHAR)
-    # author.name-short
-    write_buffer.extend("SpriteShuffler".encode('ascii'))
-    write_buffer.extend(SINGLE_BYTE_NULL_CHAR)
-    write_buffer[sprite_sheet_pointer:sprite_sheet_pointer +
-                 4] = struct.pack('<L', len(write_buffer)) # as_u32
-    write_buffer.extend(basesprite)
-    write_buffer[palettes_pointer:palettes_pointer +
-                 4] = struct.pack('<L', len(write_buffer)) # as_u32
-    write_buffer.extend(palettes)
-
-    checksum = (sum(write_buffer) + 0xFF + 0xFF) % 0x10000
+    # sprite.name, author.name, author.name-short
+    metadata = b''.join([
+        outfilename.encode('utf-16-le'), DOUBLE_BYTE_NULL_CHAR,
+        "ALttPLinkSpriteShuffler".encode('utf-16-le'), DOUBLE_BYTE_NULL_CHAR,
+        "SpriteShuffler".encode('ascii'), SINGLE_BYTE_NULL_CHAR])
+
+    # Only the header and metadata are built in memory; the sprite, palette
+    # and glove data are summed and written straight from their own buffers
+    checksum_start = 5
+    header_length = zspr_header.size
+    sprite_sheet_pointer = header_length + len(metadata)
+    palettes_pointer = sprite_sheet_pointer + len(basesprite)
+    # Glove data follows the palettes
+    palettes_length = len(basepalette) + len(baseglove)
+    write_buffer = bytearray(sprite_sheet_pointer)
+
+    zspr_header.pack_into(write_buffer, 0,
+                          HEADER_STRING, VERSION,
+                          0, 0, # checksum, filled in below
+                          sprite_sheet_pointer, len(basesprite),
+                          palettes_pointer, palettes_length,
+                          SPRITE_TYPE, RESERVED_BYTES)
+    write_buffer[header_length:] = metadata
+
+    checksum = (sum(write_buffer) + sum(basesprite) + sum(basepalette) +
+                sum(baseglove) + 0xFF + 0xFF) % 0x10000
     checksum_complement = 0xFFFF - checksum
 
-    write_buffer[checksum_start:checksum_start +
-                 2] = struct.pack('<H', checksum) # as_u16
-    write_buffer[checksum_start + 2:checksum_start +
-                 4] = struct.pack('<H', checksum_complement) # as_u16
+    zspr_checksum.pack_into(write_buffer, checksum_start,
+                            checksum, checksum_complement) # as_u16, as_u16
 
-    with open('%s' % outfilename, "wb") as zspr_file:
-        zspr_file.write(write_buffer)
+    write_file(outfilename, write_buffer, basesprite, basepalette, baseglove)
 
-def dump_rom(rom, basesprite, basepalette, baseglove, outfilename):
-    rom[0x80000:0x87000] = basesprite
-    rom[0xdd308:0xdd380] = basepalette
-    rom[0xdedf5:0xdedf9] = baseglove
-    with open('%s' % outfilename, 'wb') as outfile:
-        outfile.write(rom)
+# Only the spritesheet and palettes change, so copy the source ROM as-is and
+# patch just those two regions instead of writing out the whole ROM image
+def dump_rom(srcfile, basesprite, basepalette, outfilename):
+    shutil.copyfile(srcfile, outfilename)
+    with open(outfilename, 'r+b', buffering=0) as outfile:
+        outfile.seek(rom_sprite_offset)
+        outfile.write(basesprite)
+        outfile.seek(rom_palette_offset)
+        outfile.write(basepalette)
 
-def shuffle_link(args, sprite, spritelist):
+def shuffle_link(args, sprite, sprite_index, rng):
     logger = logging.getLogger('')
 
-    current_sprite = sprite[:]
+    # Snapshot of the unshuffled spritesheet to copy tiles from; the memoryview
+    # lets shuffle_offsets slice it without copying each tile row.  The
+    # multisprite options source every tile from ./sprites/ instead, so they
+    # don't need one.
+    if (args.multisprite_simple or args.multisprite_full):
+        current_sprite = None
+    else:
+        current_sprite = memoryview(bytes(sprite))
 
-    head_offsets_list = list(head_offsets.keys())
-    shuffled_head_offsets = head_offsets_list.copy()
-    random.shuffle(shuffled_head_offsets)
+    shuffled_head_indices = rng.sample(range(len(head_offsets_list)), len(head_offsets_list))
 
     # Link's walk cycle uses heads A0, K3, and K4 changing every couple frames;
     # if these are swapped with any random head facing any random direction,
@@ -278,68 +419,64 @@ def shuffle_link(args, sprite, spritelist):
     # left/right head walk cycle are facing the same direction.
     #
     # See https://github.com/krelbel/ALttPLinkSpriteShuffler/issues/1
-    nonwalk_head_offsets = [i for i in head_offsets_list if i not in walk_head_offsets]
-    random_facing = random.randint(0,2)
+    random_facing = rng.randint(0,2)
 
     for walk_head_offset in walk_head_offsets:
-        off = head_offsets_list.index(walk_head_offset)
-        shuffled_pose = shuffled_head_offsets[off]
+        off = head_offset_index[walk_head_offset]
 
-        if head_offsets[shuffled_pose] != random_facing:
-            # Exchange this element in shuffled_head_offsets that will end
+        if head_facings[shuffled_head_indices[off]] != random_facing:
+            # Exchange this element in shuffled_head_indices that will end
             # up at this frame of the walking animation with one facing the
             # consistent direction
+            swap_candidates = [i for i in nonwalk_head_indices
+                               if head_facings[shuffled_head_indices[i]] == random_facing]
+            swap_off = rng.choice(swap_candidates)
+            tmp = shuffled_head_indices[off]
+            shuffled_head_indices[off] = shuffled_head_indices[swap_off]
+            shuffled_head_indices[swap_off] = tmp
 
-            while True:
-                swap_pose = random.choice(nonwalk_head_offsets)
-                swap_off = head_offsets_list.index(swap_pose)
-                shuffled_swap_pose = shuffled_head_offsets[swap_off]
-                if head_offsets[shuffled_swap_pose] == random_facing:
-                    tmp = shuffled_head_offsets[off]
-                    shuffled_head_offsets[off] = shuffled_head_offsets[swap_off]
-                    shuffled_head_offsets[swap_off] = tmp
-                    break
-
-        shuffled_pose = shuffled_head_offsets[off]
+    shuffled_body_indices = rng.sample(range(len(body_offsets)), len(body_offsets))
 
-    shuffled_body_offsets = body_offsets.copy()
-    random.shuffle(shuffled_body_offsets)
+    shuffled_all_indices = rng.sample(range(len(all_offsets)), len(all_offsets))
 
-    all_offsets = head_offsets_list + body_offsets
-    shuffled_all_offsets = all_offsets.copy()
-    random.shuffle(shuffled_all_offsets)
+    # --chaos rewrites every head and body tile, so it overrides --head/--body
+    if (args.chaos):
+        shuffle_offsets(args, sprite, all_offsets, all_byte_offsets, shuffled_all_indices, sprite_index, current_sprite, rng)
+        return
 
     if (args.head):
-        shuffle_offsets(args, sprite, head_offsets_list, shuffled_head_offsets, spritelist, current_sprite)
+        shuffle_offsets(args, sprite, head_offsets_list, head_byte_offsets, shuffled_head_indices, sprite_index, current_sprite, rng)
 
     if (args.body):
-        shuffle_offsets(args, sprite, body_offsets, shuffled_body_offsets, spritelist, current_sprite)
-    
-    if (args.chaos):
-        shuffle_offsets(args, sprite, all_offsets, shuffled_all_offsets, spritelist, current_sprite)
+        shuffle_offsets(args, sprite, body_offsets, body_byte_offsets, shuffled_body_indices, sprite_index, current_sprite, rng)
 
-def shuffle_bunny(args, sprite, palette, spritelist):
+def shuffle_bunny(args, sprite, palette, sprite_index, rng):
     logger = logging.getLogger('')
 
     # Pick a random sprite, but make sure it has a non-transparent bunny sprite
     # first (just checking bunny head Z5 for nonzero pixel data here)
-    srcsheet, basespriteoffset, basepaletteoffset = pick_random_zspr(bunny_offsets[0], spritelist)
-    
-    for off in bunny_offsets:
-        for h in range(2): # All bunny sprites consist of 2x2 tiles
-            byteoffset = off*0x40 + h*0x200
-            srcoff = basespriteoffset + byteoffset
-            dstoff = byteoffset
-            for w in range(0x40):
-                write_byte(sprite, dstoff+w, srcsheet[srcoff+w])
+    picked = pick_random_zspr(bunny_offsets[0], sprite_index, rng)
+    if picked is None:
+        logger.info("WARNING: no sprite in ./sprites/ has bunny sprite data, leaving bunny sprite unchanged")
+        return
+
+    srcsheet, basespriteoffset, basepaletteoffset = picked
+
+    copy_tiles(sprite, srcsheet, [(basespriteoffset + dstoff, dstoff) for dstoff in bunny_byte_offsets])
 
     # Copy bunny palette; palettes are 4 sets of 30 bytes (green, blue, red, bunny) +
     # 4 bytes for gloves, so grab bytes 90-119 of the palette block from the source
     # .zspr file
     dstpaletteoffset = 30*3
     srcpaletteoffset = basepaletteoffset + 30*3
-    for b in range(30):
-        write_byte(palette, dstpaletteoffset+b, srcsheet[srcpaletteoffset+b])
+    palette[dstpaletteoffset:dstpaletteoffset+30] = srcsheet[srcpaletteoffset:srcpaletteoffset+30]
+
+# Clear the bits set in mask from the len(mask) bytes of sprite at offset, as
+# one big integer AND rather than a Python loop over each byte
+def clear_mask(sprite, offset, mask):
+    end = offset + len(mask)
+    masked = int.from_bytes(sprite[offset:end], 'little') & ~int.from_bytes(mask, 'little')
+    sprite[offset:end] = masked.to_bytes(len(mask), 'little')
 
 # Remove body pixels that overlap with the edge of the shadow
 def make_shadow_edge_visible(sprite):
@@ -411,52 +548,64 @@ def make_shadow_edge_visible(sprite):
         16*1+0,  # B0 stand right.  this flickers the walk cycle...
         16*12+6] # M6 sword primed right
 
+    # The left and right tiles are adjacent, so mask both in one pass
+    shadow_updown = left_shadow_updown + right_shadow_updown
+    shadow_right = left_shadow_right + right_shadow_right
+
     for off in updown_shadow_offsets:
         base = off * 0x40 + 0x200 # shadow's in the bottom 2 tiles
-        for w in range(32):
-            write_byte(sprite, base+w, (sprite[base+w] & (~(left_shadow_updown[w]))))
-        for w in range(32):
-            write_byte(sprite, base+32+w, (sprite[base+32+w] & (~(right_shadow_updown[w]))))
+        clear_mask(sprite, base, shadow_updown)
 
     for off in right_shadow_offsets:
         base = off * 0x40 + 0x200 # shadow's in the bottom 2 tiles
-        for w in range(32):
-            write_byte(sprite, base+w, (sprite[base+w] & (~(left_shadow_right[w]))))
-        for w in range(32):
-            write_byte(sprite, base+32+w, (sprite[base+32+w] & (~(right_shadow_right[w]))))
-        
+        clear_mask(sprite, base, shadow_right)
+
+# Read straight into a preallocated bytearray rather than reading into bytes
+# and copying those into a bytearray
+def read_file(srcfile):
+    data = bytearray(os.path.getsize(srcfile))
+    with open(srcfile, 'rb') as infile:
+        infile.readinto(data)
+    return data
+
+# Only the spritesheet, palettes, and gloves are ever read or patched, and
+# dump_rom copies everything else straight from the source rom, so read just
+# those three regions instead of the whole rom
+def read_region(infile, offset, length):
+    data = bytearray(length)
+    infile.seek(offset)
+    infile.readinto(data)
+    return data
 
 def open_rom(srcfile):
-    rom = bytearray(open(srcfile, 'rb').read())
-    basesprite = rom[0x80000:0x87000]
-    basepalette = rom[0xdd308:0xdd380]
-    baseglove = rom[0xdedf5:0xdedf9]
-    return rom, basesprite, basepalette, baseglove
+    with open(srcfile, 'rb') as infile:
+        basesprite = read_region(infile, rom_sprite_offset, 0x7000)
+        basepalette = read_region(infile, rom_palette_offset, 0x78)
+        baseglove = read_region(infile, rom_glove_offset, 4)
+    return basesprite, basepalette, baseglove
 
 def open_zspr(srcfile):
-    data = bytearray(open(srcfile, 'rb').read())
+    data = read_file(srcfile)
 
     # .zspr import copied with permission from SpriteSomething
     # https://github.com/Artheau/SpriteSomething/blob/master/source/meta/classes/spritelib.py#L131 (thanks miketrethewey!)
     if data[0:4] != bytes(ord(x) for x in 'ZSPR'):
-        print("ERROR, invalid .zspr file specified: " + args.zspr_in)
+        print("ERROR, invalid .zspr file specified: " + srcfile)
         return
     if data[4] == 1:
-        pixel_data_offset = int.from_bytes(
-            data[9:13], byteorder='little', signed=False)
-        pixel_data_length = int.from_bytes(
-            data[13:15], byteorder='little', signed=False)
-        palette_data_offset = int.from_bytes(
-            data[15:19], byteorder='little', signed=False)
-        palette_data_length = int.from_bytes(
-            data[19:21], byteorder='little', signed=False)
+        if len(data) < 9 + zspr_pointers.size:
+            print("ERROR, corrupt .zspr file specified: " + srcfile)
+            return
+
+        (pixel_data_offset, pixel_data_length,
+         palette_data_offset, palette_data_length) = zspr_pointers.unpack_from(data, 9)
 
         if (pixel_data_offset == 0 or
             palette_data_offset == 0 or
             pixel_data_offset + 0x7000 > palette_data_offset or
             pixel_data_offset + 0x7000 > len(data) or
             palette_data_offset + 124 > len(data)):
-            print("ERROR, corrupt .zspr file specified: " + args.zspr_in)
+            print("ERROR, corrupt .zspr file specified: " + srcfile)
             return
 
         basesprite = data[pixel_data_offset:pixel_data_offset + pixel_data_length]
@@ -497,35 +646,87 @@ def shuffle_sprite(args):
             origromname = os.path.basename(args.rom)
             shortname = os.path.splitext(origromname)[0]
         outfilename = '%s_%s.zspr' % (prefix, shortname)
-
-        logger.info("Creating .zspr file: " + outfilename)
     else:
         outfilename = '%s_%s' % (prefix, os.path.basename(args.rom))
 
-        logger.info("Creating patched ROM: " + outfilename)
+    # Number the outputs when generating more than one
+    if (args.count > 1):
+        outroot, outext = os.path.splitext(outfilename)
+        outfilenames = ['%s_%d%s' % (outroot, i + 1, outext) for i in range(args.count)]
+    else:
+        outfilenames = [outfilename]
 
+    # Load the source spritesheet and sprite index once, however many outputs
+    # are generated from them
     if args.zspr_in:
         basesprite, basepalette, baseglove = open_zspr(args.zspr_in)
     elif args.rom:
-        rom, basesprite, basepalette, baseglove = open_rom(args.rom)
+        basesprite, basepalette, baseglove = open_rom(args.rom)
 
-    spritelist = list()
-    if (args.multisprite_simple or args.multisprite_full or args.multibunny):
-        for path in Path('./sprites/').rglob('*.zspr'):
-            spritelist.append(path)
+    # Offsets pick_random_zspr will be asked about; --chaos draws from both
+    # the head and body pools, and --multibunny only checks the first bunny
+    # offset
+    index_offsets = ()
+    if (args.multisprite_simple or args.multisprite_full):
+        if (args.head or args.chaos):
+            index_offsets += head_offsets_list
+        if (args.body or args.chaos):
+            index_offsets += tuple(body_offsets)
+    if (args.multibunny):
+        index_offsets += (bunny_offsets[0],)
 
-    shuffle_link(args, basesprite, spritelist)
+    sprite_index = {}
+    if index_offsets:
+        sprites = find_sprites()
+        if not sprites:
+            logger.info("ERROR: no .zspr files found in ./sprites/, make sure you've run --dumpsprites first.")
+            return
+        sprite_index = build_sprite_index(sprites, index_offsets)
+        if not any(sprite_index.values()):
+            logger.info("ERROR: no .zspr files in ./sprites/ have usable sprite data for the selected options.")
+            return
 
-    if (args.multibunny):
-        shuffle_bunny(args, basesprite, basepalette, spritelist)
+    # Separate generator so that --seed reproduces the same shuffle
+    rng = random.Random(args.seed)
 
-    if (args.make_shadow_edge_visible):
-        make_shadow_edge_visible(basesprite)
+    # Shuffling modifies the spritesheet and palettes in place, so keep the
+    # originals to start each output from
+    origsprite = bytes(basesprite)
+    origpalette = bytes(basepalette)
 
-    if (args.zspr_out):
-        dump_zspr(basesprite, basepalette, baseglove, outfilename)
-    else:
-        dump_rom(rom, basesprite, basepalette, baseglove, outfilename)
+    for outfilename in outfilenames:
+        if (args.zspr_out):
+            logger.info("Creating .zspr file: " + outfilename)
+        else:
+            logger.info("Creating patched ROM: " + outfilename)
+
+        basesprite[:] = origsprite
+        basepalette[:] = origpalette
+
+        shuffle_link(args, basesprite, sprite_index, rng)
+
+        if (args.multibunny):
+            shuffle_bunny(args, basesprite, basepalette, sprite_index, rng)
+
+        if (args.make_shadow_edge_visible):
+            make_shadow_edge_visible(basesprite)
+
+        if (args.zspr_out):
+            dump_zspr(basesprite, basepalette, baseglove, outfilename)
+        else:
+            dump_rom(args.rom, basesprite, basepalette, outfilename)
+
+def download_sprite(sprite_url, target):
+    logger = logging.getLogger('')
+
+    try:
+        with urlopen(sprite_url) as response, open(target, 'wb') as out:
+            shutil.copyfileobj(response, out)
+    except Exception as e:
+        logger.info("Error downloading sprite. Not all sprites updated.\n\n%s: %s" % (type(e).__name__, e))
+        return False
+
+    return True
 
 # Sprite dumping logic copied from
 # https://github.com/Berserker66/MultiWorld-Utilities/blob/doors/source/classes/SpriteSelector.py
@@ -559,17 +760,17 @@ def dump_sprites(args):
         successful = False
         return
  
+    # Each download is mostly waiting on a round trip to alttpr.com, so run a
+    # batch of them at once
     updated = 0
-    for (sprite_url, filename) in needed_sprites:
-        try:
-            logger.info("Downloading needed sprite %g/%g" % (updated + 1, len(needed_sprites)))
-            target = os.path.join(alttpr_sprite_dir, filename)
-            with urlopen(sprite_url) as response, open(target, 'wb') as out:
-                shutil.copyfileobj(response, out)
-        except Exception as e:
-            logger.info("Error downloading sprite. Not all sprites updated.\n\n%s: %s" % (type(e).__name__, e))
-            successful = False
-        updated += 1
+    sprite_urls = [sprite_url for (sprite_url, _) in needed_sprites]
+    targets = [os.path.join(alttpr_sprite_dir, filename) for (_, filename) in needed_sprites]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for downloaded in executor.map(download_sprite, sprite_urls, targets):
+            logger.info("Finished downloading needed sprite %g/%g" % (updated + 1, len(needed_sprites)))
+            if not downloaded:
+                successful = False
+            updated += 1
  
     deleted = 0
     for sprite in obsolete_sprites:
@@ -581,6 +782,8 @@ def dump_sprites(args):
             successful = False
         deleted += 1
 
+    find_sprites.cache_clear()
+
     if successful:
         resultmessage = "alttpr sprites updated successfully"
 
@@ -605,6 +808,8 @@ if __name__ == '__main__':
     parser.add_argument('--multibunny', help='Pick a random bunny sprite from all bunny sprites in ./sprites/ instead of the bunny sprite in the base spritesheet.', action='store_true')
     parser.add_argument('--multisprite_simple', help='Choose each sprite randomly from all spritesheets in ./sprites/ as sources, instead of the current spritesheet in the provided rom. Keep poses unshuffled (i.e. each sprite will be sourced from the same position in a random sprite).', action='store_true')
     parser.add_argument('--multisprite_full', help='Choose each sprite randomly from all spritesheets in ./sprites/ as sources, instead of the current spritesheet in the provided rom. Shuffle poses according to other args (i.e. each sprite will be sourced from a random position in a random spritesheet according to the other --head/--body/--chaos arguments).', action='store_true')
+    parser.add_argument('--count', type=int, default=1, help='Number of shuffled sprites to generate from the same source, numbered _1, _2, etc. when more than one.')
+    parser.add_argument('--seed', type=int, help='Seed for the random number generator, to reproduce the same shuffle from the same source spritesheet and ./sprites/ folder.')
     parser.add_argument('--make_shadow_edge_visible', help='Clear body pixels that overlap with the edge of the shadow in up/right/down stand/swordprimed poses, which helps the generated sprite not interfere with glitches/bombjumps', action='store_true')
     args = parser.parse_args()
 
@@ -615,7 +820,10 @@ if __name__ == '__main__':
         if args.rom is None and args.zspr_in is None:
             input('No rom or .zspr source specified. Please run with -h to see help for further information. \nPress Enter to exit.')
             exit(1)
-        if ((args.head != True) and (args.body != True) and (args.chaos != True) and (args.multibunny != True)):
+        if args.count < 1:
+            input('--count must be at least 1. Please run with -h to see help for further information. \nPress Enter to exit.')
+            exit(1)
+        if not (args.head or args.body or args.chaos or args.multibunny):
             input('No shuffle specified. Please run with -h to see help for further information. \nPress Enter to exit.')
             exit(1)
         if args.rom and not os.path.isfile(args.rom):